@@ -1,51 +1,135 @@
-import yagmail
 from docxtpl import DocxTemplate
 import re
+import string
+import io
 import datetime
+import time
+import functools
 import os
 import google.generativeai as genai
-import json
+import orjson
 from flask import Flask, request, Response
+from jinja2 import Environment
 import requests
-import gc # <-- 1. IMPORT GARBAGE COLLECTOR
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import smtplib
+from email.message import EmailMessage
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 # --- SETTINGS ARE NOW LOADED FROM THE SERVER'S ENVIRONMENT ---
-GMAIL_USER = os.environ.get("GMAIL_USER")
-GMAIL_PASS = os.environ.get("GMAIL_PASS")
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-META_ACCESS_TOKEN = os.environ.get("META_ACCESS_TOKEN")
-PHONE_NUMBER_ID = os.environ.get("PHONE_NUMBER_ID")
-META_VERIFY_TOKEN = os.environ.get("META_VERIFY_TOKEN")
+# Read once into a frozen Config; fail at startup instead of on every webhook if anything is missing.
+_REQUIRED_ENV = ('GEMINI_API_KEY', 'GMAIL_USER', 'GMAIL_PASS', 'META_ACCESS_TOKEN', 'PHONE_NUMBER_ID', 'META_VERIFY_TOKEN')
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    gemini_key: str
+    gmail_user: str
+    gmail_pass: str
+    meta_token: str
+    phone_id: str
+    verify_token: str
+
+def load_config():
+    missing_env = [key for key in _REQUIRED_ENV if not os.environ.get(key)]
+    if missing_env:
+        raise RuntimeError(f"!!! CRITICAL: Missing required environment variables: {', '.join(missing_env)}")
+    return Config(
+        gemini_key=os.environ["GEMINI_API_KEY"],
+        gmail_user=os.environ["GMAIL_USER"],
+        gmail_pass=os.environ["GMAIL_PASS"],
+        meta_token=os.environ["META_ACCESS_TOKEN"],
+        phone_id=os.environ["PHONE_NUMBER_ID"],
+        verify_token=os.environ["META_VERIFY_TOKEN"],
+    )
+
+CFG = load_config()
 # -----------------------------------------------------------
 
 TEMPLATE_FILE = "Template.docx"
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_TEMPLATE_PATH = os.path.join(_SCRIPT_DIR, TEMPLATE_FILE)
 app = Flask(__name__)
 
+# --- BACKGROUND WORKERS (Meta needs a fast 200, the quote is built afterwards) ---
+executor = ThreadPoolExecutor(max_workers=8)
+# Separate pool for template loading so a quote job never waits on a task queued behind itself
+template_executor = ThreadPoolExecutor(max_workers=8)
+
+# --- GEMINI SYSTEM PROMPT (Static, the date arrives with each user message) ---
+_SYSTEM_PROMPT_TEMPLATE = """
+You are an assistant for a stainless steel trader. Your job is to extract
+quotation details from a user's command.
+
+Each message starts with a "Current date:" line followed by the user's command.
+
+Extract the following fields:
+- q_no: The quotation number.
+- date: The date for the quote. If not mentioned, use the current date.
+- company_name: The customer's company name (e.g., "Raj Pvt Ltd").
+- customer_name: The contact person's name (e.g., "Raju").
+- product: The full product description (e.g., "3 inch SS Pipe Sch 40").
+- quantity: The numerical quantity of items (e.g., "500"). Extract only the number.
+- rate: The price per item (e.g., "600").
+- units: The unit of measurement (e.g., "Pcs", "Nos", "Kgs"). Default to "Nos" if not specified.
+- hsn: The HSN code (e.g., "7304").
+- email: The customer's email address.
+
+Return the result ONLY as a single, minified JSON string. Do not add any
+other text, greetings, code blocks (like ```json), or explanations.
+
+Example:
+Current date: March 05, 2025
+User: "quote 101 for Raju at Raj pvt ltd, 500 pcs 3in pipe at 600, hsn 7304, email raju@gmail.com"
+AI: {"q_no":"101","date":"March 05, 2025","company_name":"Raj pvt ltd","customer_name":"Raju","product":"3in pipe","quantity":"500","rate":"600","units":"Pcs","hsn":"7304","email":"raju@gmail.com"}
+"""
+
+# --- CHEAP PRE-FILTER FOR COMMANDS ---
+_EMAIL_RE = re.compile(r'[^\s@]+@[^\s@]+\.[^\s@]+')
+_DIGIT_RE = re.compile(r'\d')
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.S)
+
+# --- REQUIRED AND OPTIONAL QUOTE FIELDS ---
+_REQUIRED = ('product', 'customer_name', 'email', 'rate', 'quantity')
+_DEFAULT_CONTEXT = {'date': "", 'company_name': "", 'hsn': "", 'q_no': "", 'units': "Nos"}
+
 # --- CONFIGURE GEMINI API (Done once on start) ---
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-    except Exception as e:
-        print(f"!!! CRITICAL: Could not configure Gemini API: {e}")
-else:
-    print("!!! CRITICAL: GEMINI_API_KEY not found in environment.")
+_GEMINI_MODEL = None
+try:
+    genai.configure(api_key=CFG.gemini_key)
+    _GEMINI_MODEL = genai.GenerativeModel(
+        'models/gemini-pro-latest',
+        system_instruction=_SYSTEM_PROMPT_TEMPLATE,
+        generation_config={"response_mime_type": "application/json", "temperature": 0}
+    )
+except Exception as e:
+    print(f"!!! CRITICAL: Could not configure Gemini API: {e}")
+
+# --- META GRAPH API SESSION (keeps the HTTPS connection alive between replies) ---
+META_URL = f"https://graph.facebook.com/v19.0/{CFG.phone_id}/messages"
+META_HEADERS = {
+    "Authorization": f"Bearer {CFG.meta_token}",
+    "Content-Type": "application/json"
+}
+META_SESSION = requests.Session()
+META_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+META_SESSION.headers.update(META_HEADERS)
 
 # --- WHATSAPP REPLY FUNCTION ---
 def send_whatsapp_reply(to_phone_number, message_text):
-    if not META_ACCESS_TOKEN or not PHONE_NUMBER_ID:
-        print("!!! ERROR: Meta API keys (TOKEN or ID) are missing. Cannot send reply.")
-        return
-
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {META_ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
     payload = { "messaging_product": "whatsapp", "to": to_phone_number, "type": "text", "text": { "body": message_text } }
 
     response = None
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = META_SESSION.post(META_URL, json=payload, timeout=(3.05, 10))
         response.raise_for_status()
         print(f"Successfully sent WhatsApp reply to {to_phone_number}")
     except requests.exceptions.RequestException as e:
@@ -56,127 +140,422 @@ def send_whatsapp_reply(to_phone_number, message_text):
         else:
             print("No response received from Meta API.")
 
+# --- CURRENT DATE (Formatted at most once a minute) ---
+@functools.lru_cache(maxsize=1)
+def _date_for_minute(minute):
+    today = datetime.date.today()
+    return today, today.strftime('%B %d, %Y')
+
+def current_date():
+    # Minute buckets line up with midnight, so the date never goes stale.
+    return _date_for_minute(int(time.time() // 60))
+
+# --- AI PARSE CACHE (Small LRU shared by all worker threads) ---
+_AI_CACHE_SIZE = 256
+_ai_cache = OrderedDict()
+_ai_cache_lock = threading.Lock()
+
+def get_cached_parse(cache_key):
+    with _ai_cache_lock:
+        context = _ai_cache.get(cache_key)
+        if context is None:
+            return None
+        _ai_cache.move_to_end(cache_key)
+        return dict(context) # Callers get their own copy
+
+def cache_parse(cache_key, context):
+    with _ai_cache_lock:
+        _ai_cache[cache_key] = dict(context)
+        _ai_cache.move_to_end(cache_key)
+        if len(_ai_cache) > _AI_CACHE_SIZE:
+            _ai_cache.popitem(last=False)
+
 # --- PARSE COMMAND FUNCTION ---
+def looks_like_quote_command(command_text):
+    # A quote always needs an email and some numbers; "hi" or "thanks" never can be one.
+    return bool(len(command_text) >= 20 and _EMAIL_RE.search(command_text) and _DIGIT_RE.search(command_text))
+
 def parse_command_with_ai(command_text):
+    if not looks_like_quote_command(command_text):
+        print("Command is too short or has no email/number. Skipping AI parsing.")
+        return None
+
+    today, today_str = current_date()
+
+    # Meta redeliveries and resent messages hit this cache instead of Gemini. The date is
+    # part of the key, so yesterday's parses (with yesterday's default date) never match.
+    cache_key = (today_str, " ".join(command_text.split()))
+    cached_context = get_cached_parse(cache_key)
+    if cached_context is not None:
+        print(f"Using cached AI parse for this command: {cached_context}")
+        return cached_context
+
     print("Sending command to Google AI (Gemini) for parsing...")
     try:
-        model = genai.GenerativeModel('models/gemini-pro-latest')
-        system_prompt = f"""
-        You are an assistant for a stainless steel trader. Your job is to extract
-        quotation details from a user's command.
-
-        The current date is: {datetime.date.today().strftime('%B %d, %Y')}
-
-        Extract the following fields:
-        - q_no: The quotation number.
-        - date: The date for the quote. If not mentioned, use today's date.
-        - company_name: The customer's company name (e.g., "Raj Pvt Ltd").
-        - customer_name: The contact person's name (e.g., "Raju").
-        - product: The full product description (e.g., "3 inch SS Pipe Sch 40").
-        - quantity: The numerical quantity of items (e.g., "500"). Extract only the number.
-        - rate: The price per item (e.g., "600").
-        - units: The unit of measurement (e.g., "Pcs", "Nos", "Kgs"). Default to "Nos" if not specified.
-        - hsn: The HSN code (e.g., "7304").
-        - email: The customer's email address.
-
-        Return the result ONLY as a single, minified JSON string. Do not add any
-        other text, greetings, code blocks (like ```json), or explanations.
-
-        Example:
-        User: "quote 101 for Raju at Raj pvt ltd, 500 pcs 3in pipe at 600, hsn 7304, email raju@gmail.com"
-        AI: {{"q_no":"101","date":"{datetime.date.today().strftime('%B %d, %Y')}","company_name":"Raj pvt ltd","customer_name":"Raju","product":"3in pipe","quantity":"500","rate":"600","units":"Pcs","hsn":"7304","email":"raju@gmail.com"}}
-        """
-
-        full_prompt = system_prompt + "\n\nUser: " + command_text
-        response = model.generate_content(full_prompt)
-        ai_response_json = response.text.strip().replace("```json", "").replace("```", "").strip()
-        print(f"AI response received: {ai_response_json}")
+        if _GEMINI_MODEL is None:
+            print("!!! ERROR: Gemini model is not configured. Cannot parse command.")
+            return None
 
-        context = json.loads(ai_response_json)
+        user_turn = f"Current date: {today_str}\nUser: {command_text}"
+        response = _GEMINI_MODEL.generate_content(user_turn, stream=True)
+
+        # Stream the answer and stop reading as soon as the buffered text is complete JSON.
+        chunks = []
+        context = None
+        for chunk in response:
+            chunks.append(chunk.text)
+            if "}" not in chunk.text:
+                continue
+            ai_response_json = "".join(chunks).strip()
+            try:
+                context = orjson.loads(ai_response_json)
+                break
+            except ValueError:
+                continue
+
+        if context is None:
+            # Not valid JSON as a whole (stray prose or fences): fall back to the outermost {...}.
+            ai_response_json = "".join(chunks).strip()
+            match = _JSON_OBJECT_RE.search(ai_response_json)
+            if match:
+                ai_response_json = match.group(0)
+            context = orjson.loads(ai_response_json)
+        print(f"AI response received: {ai_response_json}")
 
-        required_fields = ['product', 'customer_name', 'email', 'rate', 'quantity']
-        for field in required_fields:
-            if field not in context or not context[field]:
-                print(f"!!! ERROR: AI did not find a required field: '{field}' or value was empty.")
-                return None
+        missing = [field for field in _REQUIRED if not context.get(field)]
+        if missing:
+            print(f"!!! ERROR: AI did not find required fields {missing} or their values were empty.")
+            return None
 
         try:
             price_num = float(context['rate'])
             qty_num = int(context['quantity'])
-            total_num = price_num * qty_num
 
-            context['rate_formatted'] = f"₹{price_num:,.2f}"
-            context['total'] = f"₹{total_num:,.2f}"
-            context['rate'] = context['rate_formatted']
+            # Keep the numbers; the ₹ strings are only built when the document is rendered.
+            context['_rate_num'] = price_num
+            context['_qty_num'] = qty_num
+            context['_total_num'] = price_num * qty_num
             context['quantity'] = str(qty_num)
         except ValueError:
             print(f"!!! ERROR: AI returned 'rate' or 'quantity' as invalid numbers.")
             return None
 
-        if 'date' not in context or not context['date']: context['date'] = datetime.date.today().strftime("%B %d, %Y")
-        if 'company_name' not in context: context['company_name'] = ""
-        if 'hsn' not in context: context['hsn'] = ""
-        if 'q_no' not in context: context['q_no'] = ""
-        if 'units' not in context or not context['units']: context['units'] = "Nos"
+        context = {**_DEFAULT_CONTEXT, **context}
+        if not context['date']: context['date'] = today_str
+        if not context['units']: context['units'] = "Nos"
+        context['_today'] = today # Reused for the filename so the date is only read once per quote
 
         print(f"Parsed context: {context}")
+        cache_parse(cache_key, context)
         return context
 
     except Exception as e:
         print(f"!!! ERROR during AI processing or validation: {e}")
         return None
 
+# --- LOAD TEMPLATE (Read once on start, every quote renders from these bytes) ---
+def load_template_bytes():
+    try:
+        with open(_TEMPLATE_PATH, "rb") as f:
+            return f.read()
+    except Exception as e:
+        print(f"!!! CRITICAL: Could not read template '{TEMPLATE_FILE}'. Error: {e}")
+        return None
+
+TEMPLATE_BYTES = load_template_bytes()
+
+# --- TEMPLATE RENDER CACHES ---
+# Every quote starts from the same Template.docx, so the XML docxtpl produces before
+# rendering is identical each time. Cache the regex clean-up (patch_xml) and the compiled
+# Jinja template for it; only template.render(context) then runs per quote.
+# patch_xml and map_tree are docxtpl internals, not public API: docxtpl is pinned in
+# requirements.txt to the version these overrides were checked against.
+_TEMPLATE_CACHE_SIZE = 32 # body, headers and footers of one template fit easily
+
+class CachedEnvironment(Environment):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiled = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        template = self._compiled.get(source)
+        if template is None:
+            template = super().from_string(source)
+            if len(self._compiled) >= _TEMPLATE_CACHE_SIZE:
+                self._compiled.clear()
+            self._compiled[source] = template
+        return template
+
+_patched_xml_cache = {}
+
+class CachedDocxTemplate(DocxTemplate):
+    def patch_xml(self, src_xml):
+        patched = _patched_xml_cache.get(src_xml)
+        if patched is None:
+            patched = super().patch_xml(src_xml)
+            if len(_patched_xml_cache) >= _TEMPLATE_CACHE_SIZE:
+                _patched_xml_cache.clear()
+            _patched_xml_cache[src_xml] = patched
+        return patched
+
+    def map_tree(self, tree):
+        # Move the rendered children into the existing <w:body> instead of swapping the
+        # element out, so lxml doesn't re-parent a whole new body on every render.
+        body = self.docx._element.body
+        for child in list(body):
+            body.remove(child)
+        body.extend(list(tree))
+
+JINJA_ENV = CachedEnvironment() # Shared by all renders instead of one per document
+
+# --- FILENAME SANITIZING TABLE (for str.translate) ---
+# Filled in lazily per codepoint: a full 0x110000-entry table would cost far more
+# memory than it saves, and customer names only ever use a handful of characters.
+class SafeNameTable(dict):
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        value = char if char.isalnum() or char in " _-" else None
+        self[codepoint] = value
+        return value
+
+_SAFE_NAME_TABLE = SafeNameTable()
+
+# --- PRICE FORMATTING ---
+def format_inr(amount):
+    return f"₹{amount:,.2f}"
+
 # --- CREATE QUOTATION FUNCTION ---
-def create_quotation_from_template(context):
+def load_template_document():
+    doc = CachedDocxTemplate(io.BytesIO(TEMPLATE_BYTES))
+    doc.init_docx() # Unzip and parse now, render() then reuses the loaded document
+    return doc
+
+def create_quotation_from_template(context, doc_future=None):
+    if TEMPLATE_BYTES is None:
+        print(f"!!! ERROR: Template '{TEMPLATE_FILE}' was not loaded. Cannot create quotation.")
+        return None
+
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        template_path = os.path.join(script_dir, TEMPLATE_FILE)
-        doc = DocxTemplate(template_path)
+        doc = doc_future.result() if doc_future is not None else load_template_document()
     except Exception as e:
         print(f"!!! ERROR: Could not load template '{TEMPLATE_FILE}'. Error: {e}")
         return None
 
     try:
-        doc.render(context)
-        safe_customer_name = "".join(c for c in context['customer_name'] if c.isalnum() or c in " _-").rstrip()
-        filename = f"Quotation_{safe_customer_name}_{datetime.date.today()}.docx"
-        output_path = os.path.join(script_dir, filename)
-        doc.save(output_path)
-        print(f"Successfully created '{output_path}'")
-        return output_path
+        render_context = {**context, 'rate': format_inr(context['_rate_num']), 'total': format_inr(context['_total_num'])}
+        doc.render(render_context, jinja_env=JINJA_ENV)
+        safe_customer_name = context['customer_name'].translate(_SAFE_NAME_TABLE).rstrip()
+        filename = f"Quotation_{safe_customer_name}_{context['_today']}.docx"
+        # Keep the document in memory, it is attached to the email straight from the buffer.
+        doc_buffer = io.BytesIO()
+        doc.save(doc_buffer)
+        print(f"Successfully created '{filename}' in memory")
+        return doc_buffer.getvalue(), filename
     except Exception as e:
         print(f"!!! ERROR rendering or saving the document: {e}")
         return None
 
+# --- SMTP SESSION POOL (logged-in sessions reused across emails) ---
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_POOL_SIZE = 3 # Per gunicorn worker; Gmail limits concurrent connections per account
+DOCX_SUBTYPE = "vnd.openxmlformats-officedocument.wordprocessingml.document"
+_smtp_idle = queue.LifoQueue() # Most recently used first, so spare sessions can go idle
+_smtp_slots = threading.BoundedSemaphore(SMTP_POOL_SIZE)
+
+def open_smtp_session():
+    print("Opening new SMTP session to Gmail...")
+    smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+    smtp.login(CFG.gmail_user, CFG.gmail_pass)
+    return smtp
+
+def close_smtp_session(smtp):
+    try:
+        smtp.quit()
+    except Exception as close_err:
+        print(f"Warning: Could not close stale SMTP session: {close_err}")
+
+def is_stale_smtp_error(smtp_err):
+    # Gmail usually closes an idle session by answering the next command with a 4xx
+    # (e.g. "451 4.4.2 Timeout - closing connection" or 421), raised as SMTPSenderRefused.
+    if isinstance(smtp_err, smtplib.SMTPResponseException):
+        return 400 <= smtp_err.smtp_code < 500
+    return True
+
+def send_via_smtp_pool(msg):
+    with _smtp_slots:
+        try:
+            smtp = _smtp_idle.get_nowait()
+        except queue.Empty:
+            smtp = open_smtp_session()
+
+        try:
+            try:
+                smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, ConnectionError) as smtp_err:
+                if not is_stale_smtp_error(smtp_err):
+                    raise
+                # Gmail drops idle sessions; reconnect once and retry.
+                print(f"SMTP session was dropped ({smtp_err}), reconnecting...")
+                close_smtp_session(smtp)
+                smtp = open_smtp_session()
+                smtp.send_message(msg)
+        except smtplib.SMTPRecipientsRefused:
+            # Only the address was rejected; the session itself is still good.
+            _smtp_idle.put(smtp)
+            raise
+        except Exception:
+            close_smtp_session(smtp)
+            raise
+
+        _smtp_idle.put(smtp)
+
 # --- SEND EMAIL FUNCTION ---
-def send_email_with_attachment(recipient_email, subject, body, attachment_path):
-    if not attachment_path:
+def send_email_with_attachment(recipient_email, subject, body, attachment_bytes, filename):
+    if not attachment_bytes:
         print("Cannot send email, no attachment was created.")
         return False
 
-    if not GMAIL_USER or not GMAIL_PASS:
-        print("!!! ERROR: GMAIL_USER or GMAIL_PASS not set. Cannot send email.")
-        return False
-
     try:
-        yag = yagmail.SMTP(GMAIL_USER, GMAIL_PASS)
-        yag.send(
-            to=recipient_email,
-            subject=subject,
-            contents=body,
-            attachments=attachment_path,
-        )
+        msg = EmailMessage()
+        msg['From'] = CFG.gmail_user
+        msg['To'] = recipient_email
+        msg['Subject'] = subject
+        msg.set_content(body)
+        msg.add_attachment(attachment_bytes, maintype="application", subtype=DOCX_SUBTYPE, filename=filename)
+
+        send_via_smtp_pool(msg)
         print(f"Email successfully sent to {recipient_email}")
-        try:
-            os.remove(attachment_path)
-            print(f"Cleaned up '{attachment_path}'")
-        except Exception as remove_err:
-            print(f"Warning: Could not remove temporary file {attachment_path}: {remove_err}")
         return True
     except Exception as e:
         print(f"Error sending email: {e}")
         return False
 
+# --- EMAIL TEXT (Built once, filled in per quote) ---
+_EMAIL_SUBJECT_TMPL = string.Template("Quotation from NIVEE METAL PRODUCTS PVT LTD (Ref: $q_no)")
+_EMAIL_BODY_TMPL = string.Template("""
+Dear $customer_name,
+
+Thank you for your enquiry.
+
+Please find our official quotation attached...
+(Your full email text)
+
+Thank you,
+
+Harsh Bhandari
+Nivee Metal Products Pvt. Ltd.
+""")
+
+_NOT_UNDERSTOOD_REPLY = "Sorry, I couldn't understand your request. Please check the details and try again."
+
+# --- QUOTATION JOB (runs on the background executor) ---
+def process_quotation_job(customer_phone_number, command_text):
+    try:
+        # Reject obvious non-commands before paying for the template load below.
+        if not looks_like_quote_command(command_text):
+            print("Sorry, I couldn't understand that. (Command is too short or has no email/number)")
+            send_whatsapp_reply(customer_phone_number, _NOT_UNDERSTOOD_REPLY)
+            return
+
+        # Load the template on another thread while Gemini works on the command.
+        # If parsing fails, the load has usually already started and is simply discarded.
+        doc_future = template_executor.submit(load_template_document)
+        context = parse_command_with_ai(command_text)
+
+        if not context:
+            print("Sorry, I couldn't understand that. (AI parsing failed)")
+            send_whatsapp_reply(customer_phone_number, _NOT_UNDERSTOOD_REPLY)
+            return
+
+        print(f"\nGenerating quote for {context['customer_name']}...")
+        doc_file = create_quotation_from_template(context, doc_future)
+
+        if not doc_file:
+            print("Error: Could not create the document.")
+            send_whatsapp_reply(customer_phone_number, "Sorry, an internal error occurred while creating your document.")
+            return
+
+        email_subject = _EMAIL_SUBJECT_TMPL.substitute(q_no=context.get('q_no', 'N/A'))
+        email_body = _EMAIL_BODY_TMPL.substitute(customer_name=context['customer_name'])
+
+        doc_bytes, doc_filename = doc_file
+        email_sent = send_email_with_attachment(context['email'], email_subject, email_body, doc_bytes, doc_filename)
+
+        if email_sent:
+            print("Process complete!")
+            reply_msg = f"Success! Your quotation for {context['product']} has been generated and sent to {context['email']}."
+            send_whatsapp_reply(customer_phone_number, reply_msg)
+        else:
+            print("Process failed.")
+            send_whatsapp_reply(customer_phone_number, f"Sorry, I created the quote but failed to send the email to {context['email']}.")
+    except Exception as e:
+        # Nobody awaits the future, so anything not caught here would vanish silently.
+        print(f"!!! ERROR in background quotation job: {e}")
+
+# --- COMMAND COALESCING (joins a command split across several WhatsApp messages) ---
+# A message that can't be a full quote on its own (no email or no numbers yet) waits a
+# short while for the rest of the command from the same customer. Complete commands are
+# queued straight away, so separate quotes sent back to back are never merged.
+# The buffer only lives in this process, so it relies on the Procfile's single gunicorn
+# worker (-w 1): with several workers the halves of one command could land on different ones.
+_FRAGMENT_WINDOW_SECONDS = 2.0
+_pending_fragments = {}
+_pending_fragments_lock = threading.Lock()
+
+def queue_command(customer_phone_number, command_text):
+    with _pending_fragments_lock:
+        pending = _pending_fragments.pop(customer_phone_number, None)
+        if pending is not None:
+            pending['timer'].cancel()
+            command_text = pending['text'] + "\n" + command_text
+
+        if looks_like_quote_command(command_text):
+            executor.submit(process_quotation_job, customer_phone_number, command_text)
+            return
+
+        pending = {'text': command_text}
+        pending['timer'] = threading.Timer(_FRAGMENT_WINDOW_SECONDS, flush_fragments, args=(customer_phone_number, pending))
+        pending['timer'].daemon = True
+        _pending_fragments[customer_phone_number] = pending
+        pending['timer'].start()
+
+def flush_fragments(customer_phone_number, pending):
+    with _pending_fragments_lock:
+        # A newer message may already have taken over this customer's entry.
+        if _pending_fragments.get(customer_phone_number) is not pending:
+            return
+        del _pending_fragments[customer_phone_number]
+    executor.submit(process_quotation_job, customer_phone_number, pending['text'])
+
+# --- WEBHOOK PAYLOAD HELPERS ---
+_PATH = ('entry', 0, 'changes', 0, 'value')
+
+def _dig(d, path):
+    for p in path:
+        d = d[p]
+    return d
+
+# --- REDELIVERY GUARD (Meta can send the same message more than once) ---
+# The seen ids only live in this process. That is why the Procfile runs a single gunicorn
+# worker (-w 1, more threads): with several workers a redelivery could land on another one.
+_SEEN_MESSAGES_SIZE = 1024
+_seen_message_ids = OrderedDict()
+_seen_message_lock = threading.Lock()
+
+def is_duplicate_message(message_id):
+    if not message_id:
+        return False
+    with _seen_message_lock:
+        if message_id in _seen_message_ids:
+            return True
+        _seen_message_ids[message_id] = True
+        if len(_seen_message_ids) > _SEEN_MESSAGES_SIZE:
+            _seen_message_ids.popitem(last=False)
+        return False
+
 # --- WEBHOOK LISTENER ---
 @app.route("/webhook", methods=['GET', 'POST'])
 def handle_webhook():
@@ -184,7 +563,7 @@ def handle_webhook():
     if request.method == 'GET':
         print("Webhook received GET verification request...")
         if request.args.get('hub.mode') == 'subscribe' and request.args.get('hub.verify_token'):
-            if request.args.get('hub.verify_token') == META_VERIFY_TOKEN:
+            if request.args.get('hub.verify_token') == CFG.verify_token:
                 print("Verification successful!")
                 return Response(request.args.get('hub.challenge'), status=200)
             else:
@@ -198,25 +577,34 @@ def handle_webhook():
         print("Webhook received POST (new message or status)!")
         customer_phone_number = None
         command_text = None
+        raw_body = None
 
         try:
-            data = request.json
-            if 'entry' not in data or not data['entry'] or 'changes' not in data['entry'][0] or not data['entry'][0]['changes']:
-                 print("Received unrecognized structure (no entry/changes). Ignoring.")
-                 return Response(status=200)
-
-            change = data['entry'][0]['changes'][0]
+            raw_body = request.get_data(cache=False)
+            # Most webhooks are delivery/read statuses; skip those without parsing the JSON.
+            if b'"messages"' not in raw_body:
+                print("Received webhook without messages (status update or other event). Ignoring.")
+                return Response(status=200)
+            data = orjson.loads(raw_body)
+            try:
+                value = _dig(data, _PATH)
+            except (KeyError, IndexError, TypeError):
+                print("Received unrecognized structure (no entry/changes/value). Ignoring.")
+                return Response(status=200)
 
-            if 'value' in change and 'messages' in change['value'] and change['value']['messages']:
-                message_data = change['value']['messages'][0]
+            if value.get('messages'):
+                message_data = value['messages'][0]
+                if is_duplicate_message(message_data.get('id')):
+                    print(f"Message {message_data.get('id')} was already queued (Meta redelivery). Ignoring.")
+                    return Response(status=200)
                 if message_data.get('type') == 'text':
                     customer_phone_number = message_data['from']
                     command_text = message_data['text']['body']
                 else:
                     print(f"Received non-text message type: {message_data.get('type')}. Ignoring.")
                     return Response(status=200)
-            elif 'value' in change and 'statuses' in change['value'] and change['value']['statuses']:
-                status_data = change['value']['statuses'][0]
+            elif value.get('statuses'):
+                status_data = value['statuses'][0]
                 print(f"Received status update: {status_data.get('status')} for message {status_data.get('id')}. Ignoring.")
                 return Response(status=200)
             else:
@@ -225,54 +613,11 @@ def handle_webhook():
 
         except Exception as e:
             print(f"Error parsing incoming JSON from Meta: {e}")
-            print(f"Full data received: {request.data}")
+            print(f"Full data received: {raw_body}")
             return Response(status=200)
 
         if command_text and customer_phone_number:
-            context = parse_command_with_ai(command_text)
-
-            # --- 2. ADD GARBAGE COLLECTION ---
-            gc.collect() # Try to free up memory after AI call
-            # --------------------------------
-
-            if not context:
-                print("Sorry, I couldn't understand that. (AI parsing failed)")
-                send_whatsapp_reply(customer_phone_number, "Sorry, I couldn't understand your request. Please check the details and try again.")
-                return Response(status=200)
-
-            print(f"\nGenerating quote for {context['customer_name']}...")
-            doc_file = create_quotation_from_template(context)
-
-            if not doc_file:
-                print("Error: Could not create the document.")
-                send_whatsapp_reply(customer_phone_number, "Sorry, an internal error occurred while creating your document.")
-                return Response(status=200)
-
-            email_subject = f"Quotation from NIVEE METAL PRODUCTS PVT LTD (Ref: {context.get('q_no', 'N/A')})"
-            email_body = f"""
-            Dear {context['customer_name']},
-
-            Thank you for your enquiry.
-
-            Please find our official quotation attached...
-            (Your full email text)
-
-            Thank you,
-
-            Harsh Bhandari
-            Nivee Metal Products Pvt. Ltd.
-            """
-
-            email_sent = send_email_with_attachment(context['email'], email_subject, email_body, doc_file)
-
-            if email_sent:
-                print("Process complete!")
-                reply_msg = f"Success! Your quotation for {context['product']} has been generated and sent to {context['email']}."
-                send_whatsapp_reply(customer_phone_number, reply_msg)
-            else:
-                print("Process failed.")
-                send_whatsapp_reply(customer_phone_number, f"Sorry, I created the quote but failed to send the email to {context['email']}.")
-
+            queue_command(customer_phone_number, command_text)
             return Response(status=200)
         else:
             print("Webhook processed but no command text found. Ignoring.")
@@ -280,11 +625,6 @@ def handle_webhook():
 
 # --- START THE SERVER ---
 if __name__ == "__main__":
-    if not all([GEMINI_API_KEY, GMAIL_USER, GMAIL_PASS, META_ACCESS_TOKEN, PHONE_NUMBER_ID, META_VERIFY_TOKEN]):
-         print("!!! CRITICAL: One or more required environment variables are missing.")
-    else:
-        print("All required API keys found in environment.")
-
     port = int(os.environ.get("PORT", 5000))
     print(f"Starting Flask server on host 0.0.0.0, port {port}")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file